@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+import numpy as np
+import faiss
+
+class SemanticCache:
+    def __init__(self, dimension: int = 384, threshold: float = 0.85, ttl: float = 300, max_entries: int = 1024):
+        self.dimension = dimension
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # IDMap keeps ids stable so evicted vectors can be removed from the index
+        self.index = faiss.IndexIDMap(faiss.IndexFlatIP(dimension))
+        self.entries: "OrderedDict[int, tuple]" = OrderedDict()  # id -> (response, timestamp)
+        self._next_id = 0
+        self._lock = threading.Lock()
+    
+    def _remove(self, entry_id: int):
+        """Drop an entry from both the index and the LRU order"""
+        self.index.remove_ids(np.array([entry_id], dtype='int64'))
+        self.entries.pop(entry_id, None)
+    
+    def get(self, embedding: np.ndarray) -> Optional[Any]:
+        """Return the cached response for a normalized query embedding, if similar enough"""
+        with self._lock:
+            if self.index.ntotal == 0:
+                return None
+            
+            scores, ids = self.index.search(embedding.astype('float32'), 1)
+            score, entry_id = float(scores[0][0]), int(ids[0][0])
+            if entry_id < 0 or score < self.threshold:
+                return None
+            
+            response, timestamp = self.entries[entry_id]
+            if time.time() - timestamp > self.ttl:
+                self._remove(entry_id)
+                return None
+            
+            self.entries.move_to_end(entry_id)
+            return response
+    
+    def put(self, embedding: np.ndarray, response: Any):
+        """Store a response under a normalized query embedding"""
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            
+            self.index.add_with_ids(embedding.astype('float32'), np.array([entry_id], dtype='int64'))
+            self.entries[entry_id] = (response, time.time())
+            
+            while len(self.entries) > self.max_entries:
+                oldest_id = next(iter(self.entries))
+                self._remove(oldest_id)
+    
+    def clear(self):
+        """Remove all cached entries"""
+        with self._lock:
+            self.index.reset()
+            self.entries.clear()
+
+class LRUCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[Any, tuple]" = OrderedDict()  # key -> (value, timestamp)
+        self._lock = threading.Lock()
+    
+    def get(self, key: Any) -> Optional[Any]:
+        """Return the cached value for an exact key, if present and not expired"""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            
+            value, timestamp = entry
+            if time.time() - timestamp > self.ttl:
+                del self.entries[key]
+                return None
+            
+            self.entries.move_to_end(key)
+            return value
+    
+    def put(self, key: Any, value: Any):
+        """Store a value, evicting the least recently used entry when full"""
+        with self._lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def clear(self):
+        """Remove all cached entries"""
+        with self._lock:
+            self.entries.clear()
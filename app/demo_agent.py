@@ -1,8 +1,11 @@
 import os
 import json
+import threading
+from collections import defaultdict, deque
 from typing import Dict, List, Any, Optional
 from app.tools import get_support_tools
 from app.rag_engine import get_rag_engine
+from app.routing import build_keyword_index, match_categories, match_restaurant, split_words, tokenize
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,41 +14,54 @@ class DemoSupportAgent:
     def __init__(self):
         self.tools = get_support_tools()
         self.rag_engine = get_rag_engine()
-        self.conversation_history = []
+        self.conversation_history: Dict[str, deque] = defaultdict(lambda: deque(maxlen=8))
+        self._history_lock = threading.Lock()
         
-        self.rag_engine.initialize()
+        # Keyword -> category index, so a message is classified with one pass over its tokens
+        self._demo_order_ids = frozenset({"fd123456789", "fd987654321"})
+        self._keyword_index = build_keyword_index({
+            "track": {"track*", "status", "order*"},
+            "faq": {"cancel*", "refund*", "payment*", "delivery", "how", "what", "when"},
+            "refund": {"refund*"}
+        })
+        
+        self._formatters = {
+            "track_order": self._fmt_track_order,
+            "search_faq": self._fmt_search_faq,
+            "process_refund": self._fmt_process_refund,
+            "get_restaurant_info": self._fmt_get_restaurant_info
+        }
     
     def _simulate_function_call(self, user_message: str) -> Dict[str, Any]:
         """Simulate function calls based on user message patterns"""
-        message_lower = user_message.lower()
+        # Lowercase and split once; routing and argument extraction share the words
+        words = split_words(user_message)
+        tokens = tokenize(words)
+        categories = match_categories(tokens, self._keyword_index)
+        demo_order_ids = tokens & self._demo_order_ids
         
-        if any(word in message_lower for word in ["track", "status", "order"]):
-            if "fd123456789" in message_lower:
-                return {
-                    "function_name": "track_order",
-                    "result": self.tools.track_order("FD123456789")
-                }
-            elif "fd987654321" in message_lower:
-                return {
-                    "function_name": "track_order", 
-                    "result": self.tools.track_order("FD987654321")
-                }
+        if "track" in categories and demo_order_ids:
+            order_id = "FD123456789" if "fd123456789" in demo_order_ids else "FD987654321"
+            return {
+                "function_name": "track_order",
+                "result": self.tools.track_order(order_id)
+            }
         
-        if any(word in message_lower for word in ["cancel", "refund", "payment", "delivery", "how", "what", "when"]):
+        if "faq" in categories:
             return {
                 "function_name": "search_faq",
                 "result": self.tools.search_faq(user_message)
             }
         
-        if "refund" in message_lower and any(order_id in message_lower for order_id in ["fd123456789", "fd987654321"]):
-            order_id = "FD123456789" if "fd123456789" in message_lower else "FD987654321"
+        if "refund" in categories and demo_order_ids:
+            order_id = "FD123456789" if "fd123456789" in demo_order_ids else "FD987654321"
             return {
                 "function_name": "process_refund",
                 "result": self.tools.process_refund(order_id, "Food was cold")
             }
         
-        if any(restaurant in message_lower for restaurant in ["mario", "sushi", "burger", "thai"]):
-            restaurant_name = "Mario's Pizza" if "mario" in message_lower else "Sushi Palace"
+        restaurant_name = match_restaurant(words)
+        if restaurant_name:
             return {
                 "function_name": "get_restaurant_info",
                 "result": self.tools.get_restaurant_info(restaurant_name)
@@ -57,47 +73,65 @@ class DemoSupportAgent:
             "result": self.tools.search_faq(user_message)
         }
     
+    def _fmt_track_order(self, result: Dict[str, Any]) -> str:
+        """Format an order tracking result"""
+        lines = [
+            f"📦 **Order {result['order_id']}**",
+            f"Status: {result['status'].replace('_', ' ').title()}",
+            f"Restaurant: {result['restaurant']}",
+            f"Total: ${result['total_amount']}"
+        ]
+        if result.get('time_remaining'):
+            lines.append(f"Time remaining: {result['time_remaining']}")
+        if result.get('driver_name'):
+            lines.append(f"Driver: {result['driver_name']}")
+        lines.extend(["", "", "I can help you with any questions about your order!"])
+        return "\n".join(lines)
+    
+    def _fmt_search_faq(self, result: Dict[str, Any]) -> str:
+        """Format FAQ search results"""
+        blocks = ["📚 **Here's what I found:**"]
+        blocks.extend(f"**Q:** {faq['question']}\n**A:** {faq['answer']}" for faq in result['faqs'])
+        blocks.append("Is there anything else I can help you with?")
+        return "\n\n".join(blocks)
+    
+    def _fmt_process_refund(self, result: Dict[str, Any]) -> str:
+        """Format a refund result"""
+        return f"💰 {result['message']}\n\nI've processed your refund request. Is there anything else I can assist you with?"
+    
+    def _fmt_get_restaurant_info(self, result: Dict[str, Any]) -> str:
+        """Format restaurant details"""
+        restaurant = result['restaurant']
+        return "\n".join([
+            f"🍽️ **{restaurant['name']}**",
+            f"Cuisine: {restaurant['cuisine']}",
+            f"Rating: {restaurant['rating']}/5",
+            f"Delivery time: {restaurant['delivery_time']}",
+            f"Delivery fee: ${restaurant['delivery_fee']}",
+            "",
+            "Would you like to know more about this restaurant?"
+        ])
+    
     def _format_demo_response(self, function_name: str, result: Dict[str, Any], user_message: str) -> str:
         """Format a demo response"""
         if not result.get("success", False):
             return f"❌ {result.get('message', 'Unknown error')}"
         
-        if function_name == "track_order":
-            order_info = f"📦 **Order {result['order_id']}**\n"
-            order_info += f"Status: {result['status'].replace('_', ' ').title()}\n"
-            order_info += f"Restaurant: {result['restaurant']}\n"
-            order_info += f"Total: ${result['total_amount']}\n"
-            if result.get('time_remaining'):
-                order_info += f"Time remaining: {result['time_remaining']}\n"
-            if result.get('driver_name'):
-                order_info += f"Driver: {result['driver_name']}\n"
-            return order_info + "\n\nI can help you with any questions about your order!"
-        
-        elif function_name == "search_faq":
-            faq_text = f"📚 **Here's what I found:**\n\n"
-            for faq in result['faqs']:
-                faq_text += f"**Q:** {faq['question']}\n"
-                faq_text += f"**A:** {faq['answer']}\n\n"
-            return faq_text + "Is there anything else I can help you with?"
-        
-        elif function_name == "process_refund":
-            return f"💰 {result['message']}\n\nI've processed your refund request. Is there anything else I can assist you with?"
-        
-        elif function_name == "get_restaurant_info":
-            restaurant = result['restaurant']
-            info_text = f"🍽️ **{restaurant['name']}**\n"
-            info_text += f"Cuisine: {restaurant['cuisine']}\n"
-            info_text += f"Rating: {restaurant['rating']}/5\n"
-            info_text += f"Delivery time: {restaurant['delivery_time']}\n"
-            info_text += f"Delivery fee: ${restaurant['delivery_fee']}\n"
-            return info_text + "\nWould you like to know more about this restaurant?"
-        
-        return result.get('message', 'Function executed successfully')
+        formatter = self._formatters.get(function_name)
+        if formatter is None:
+            return result.get('message', 'Function executed successfully')
+        return formatter(result)
+    
+    def _get_history(self, session_id: str) -> deque:
+        """Get the bounded conversation history for a session"""
+        with self._history_lock:
+            return self.conversation_history[session_id]
     
     def chat(self, user_message: str, session_id: str = "default") -> Dict[str, Any]:
         """Process user message and return demo response"""
         try:
-            self.conversation_history.append({"role": "user", "content": user_message})
+            history = self._get_history(session_id)
+            history.append({"role": "user", "content": user_message})
             
             function_result = self._simulate_function_call(user_message)
             
@@ -108,7 +142,7 @@ class DemoSupportAgent:
             )
             
             # Add AI response to conversation history
-            self.conversation_history.append({"role": "assistant", "content": response})
+            history.append({"role": "assistant", "content": response})
             
             return {
                 "success": True,
@@ -128,7 +162,8 @@ class DemoSupportAgent:
     
     def reset_conversation(self, session_id: str = "default"):
         """Reset conversation history for a session"""
-        self.conversation_history = []
+        with self._history_lock:
+            self.conversation_history.pop(session_id, None)
         return {"success": True, "message": "Conversation reset", "demo_mode": True}
 
 demo_support_agent = DemoSupportAgent()
@@ -1,13 +1,22 @@
 import os
-import json
+import hashlib
+import threading
+from collections import defaultdict, deque
 from typing import Dict, List, Any, Optional
+import orjson
 import google.generativeai as genai
 from app.tools import get_support_tools
 from app.rag_engine import get_rag_engine
+from app.cache import LRUCache
+from app.routing import ORDER_RE, RESTAURANT_MAP, build_keyword_index, match_categories, match_restaurant, split_words, tokenize
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Only these functions answer the same for every session; order, escalation and open-ended
+# Gemini replies depend on the customer or their conversation and must never be shared
+_CACHEABLE_FUNCTIONS = frozenset({"search_faq", "get_restaurant_info"})
+
 class GeminiSupportAgent:
     def __init__(self):
         genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
@@ -15,9 +24,31 @@ class GeminiSupportAgent:
         
         self.tools = get_support_tools()
         self.rag_engine = get_rag_engine()
-        self.conversation_history = []
+        self.conversation_history: Dict[str, deque] = defaultdict(lambda: deque(maxlen=8))
+        self._history_lock = threading.Lock()
+        self.exact_cache = LRUCache(max_entries=1024, ttl=300)
+        
+        # Keyword -> route index, so a message is classified with one pass over its tokens
+        self._keyword_index = build_keyword_index({
+            "track_order": {"yes", "please", "ok", "okay", "sure", "track*", "status", "where", "order*", "delivery", "show", "details", "summary"},
+            "process_refund": {"refund*", "cancel*", "return", "money back"},
+            "search_faq": {"how", "what", "when", "where", "can i", "do you", "payment*", "cancel*", "delivery", "time", "fee", "fees"},
+            "get_restaurant_info": RESTAURANT_MAP,
+            "escalate_to_human": {"manager", "supervisor", "escalate", "complaint*", "serious", "urgent"}
+        })
+        # Order in which keyword-only routes win when no order ID is present
+        self._route_priority = ("search_faq", "get_restaurant_info", "escalate_to_human")
         
-        self.rag_engine.initialize()
+        self._formatters = {
+            "track_order": self._fmt_track_order,
+            "check_delivery_time": self._fmt_check_delivery_time,
+            "process_refund": self._fmt_process_refund,
+            "search_faq": self._fmt_search_faq,
+            "escalate_to_human": self._fmt_escalate_to_human,
+            "get_restaurant_info": self._fmt_get_restaurant_info
+        }
+        # Restaurant data is static, so each restaurant's card is rendered once
+        self._restaurant_text_cache: Dict[str, str] = {}
     
     def _call_function(self, function_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
         """Call the appropriate function based on function name"""
@@ -39,133 +70,139 @@ class GeminiSupportAgent:
         except Exception as e:
             return {"success": False, "message": f"Error calling function {function_name}: {str(e)}"}
     
-    def _format_function_result(self, function_name: str, result: Dict[str, Any]) -> str:
-        """Format function result for display"""
-        if not result.get("success", False):
-            return f"❌ {result.get('message', 'Unknown error')}"
-        
-        if function_name == "track_order":
-            order_info = f"📦 **Order Summary - {result['order_id']}**\n\n"
-            order_info += f"**Customer:** {result['customer_name']}\n"
-            order_info += f"**Phone:** {result['customer_phone']}\n"
-            order_info += f"**Restaurant:** {result['restaurant']}\n"
-            order_info += f"**Status:** {result['status'].replace('_', ' ').title()}\n\n"
-            
-            order_info += f"**Items Ordered:**\n"
-            for item in result['items']:
-                order_info += f"• {item['name']} x{item['quantity']} - ${item['price']}\n"
-            
-            order_info += f"\n**Total Amount:** ${result['total_amount']}\n"
-            order_info += f"**Delivery Address:** {result['delivery_address']}\n"
-            order_info += f"**Order Time:** {result['order_time']}\n"
-            order_info += f"**Estimated Delivery:** {result['estimated_delivery']}\n"
-            
-            if result.get('time_remaining'):
-                order_info += f"**Time Remaining:** {result['time_remaining']}\n"
-            
-            if result.get('driver_name'):
-                order_info += f"**Driver:** {result['driver_name']}\n"
-                if result.get('driver_phone'):
-                    order_info += f"**Driver Phone:** {result['driver_phone']}\n"
-            
-            if result.get('special_instructions'):
-                order_info += f"**Special Instructions:** {result['special_instructions']}\n"
-            
-            if result.get('delivery_time'):
-                order_info += f"**Delivered At:** {result['delivery_time']}\n"
-            
-            return order_info
+    def _fmt_track_order(self, result: Dict[str, Any]) -> str:
+        """Format an order tracking result"""
+        lines = [
+            f"📦 **Order Summary - {result['order_id']}**",
+            "",
+            f"**Customer:** {result['customer_name']}",
+            f"**Phone:** {result['customer_phone']}",
+            f"**Restaurant:** {result['restaurant']}",
+            f"**Status:** {result['status'].replace('_', ' ').title()}",
+            "",
+            "**Items Ordered:**"
+        ]
+        lines.extend(f"• {item['name']} x{item['quantity']} - ${item['price']}" for item in result['items'])
+        lines.extend([
+            "",
+            f"**Total Amount:** ${result['total_amount']}",
+            f"**Delivery Address:** {result['delivery_address']}",
+            f"**Order Time:** {result['order_time']}",
+            f"**Estimated Delivery:** {result['estimated_delivery']}"
+        ])
         
-        elif function_name == "check_delivery_time":
-            return f"⏰ {result['message']}"
+        if result.get('time_remaining'):
+            lines.append(f"**Time Remaining:** {result['time_remaining']}")
         
-        elif function_name == "process_refund":
-            return f"💰 {result['message']}"
+        if result.get('driver_name'):
+            lines.append(f"**Driver:** {result['driver_name']}")
+            if result.get('driver_phone'):
+                lines.append(f"**Driver Phone:** {result['driver_phone']}")
         
-        elif function_name == "search_faq":
-            faq_text = f"📚 **FAQ Results:**\n\n"
-            for faq in result['faqs']:
-                faq_text += f"**Q:** {faq['question']}\n"
-                faq_text += f"**A:** {faq['answer']}\n\n"
-            return faq_text
+        if result.get('special_instructions'):
+            lines.append(f"**Special Instructions:** {result['special_instructions']}")
         
-        elif function_name == "escalate_to_human":
-            return f"👨‍💼 {result['message']}"
+        if result.get('delivery_time'):
+            lines.append(f"**Delivered At:** {result['delivery_time']}")
         
-        elif function_name == "get_restaurant_info":
-            restaurant = result['restaurant']
-            info_text = f"🍽️ **{restaurant['name']}**\n"
-            info_text += f"Cuisine: {restaurant['cuisine']}\n"
-            info_text += f"Rating: {restaurant['rating']}/5\n"
-            info_text += f"Delivery time: {restaurant['delivery_time']}\n"
-            info_text += f"Delivery fee: ${restaurant['delivery_fee']}\n"
-            return info_text
+        lines.append("")
+        return "\n".join(lines)
+    
+    def _fmt_check_delivery_time(self, result: Dict[str, Any]) -> str:
+        """Format a delivery time result"""
+        return f"⏰ {result['message']}"
+    
+    def _fmt_process_refund(self, result: Dict[str, Any]) -> str:
+        """Format a refund result"""
+        return f"💰 {result['message']}"
+    
+    def _fmt_search_faq(self, result: Dict[str, Any]) -> str:
+        """Format FAQ search results"""
+        blocks = ["📚 **FAQ Results:**"]
+        blocks.extend(f"**Q:** {faq['question']}\n**A:** {faq['answer']}" for faq in result['faqs'])
+        blocks.append("")
+        return "\n\n".join(blocks)
+    
+    def _fmt_escalate_to_human(self, result: Dict[str, Any]) -> str:
+        """Format an escalation result"""
+        return f"👨‍💼 {result['message']}"
+    
+    def _fmt_get_restaurant_info(self, result: Dict[str, Any]) -> str:
+        """Format restaurant details"""
+        restaurant = result['restaurant']
+        info_text = self._restaurant_text_cache.get(restaurant['name'])
+        if info_text is None:
+            info_text = "\n".join([
+                f"🍽️ **{restaurant['name']}**",
+                f"Cuisine: {restaurant['cuisine']}",
+                f"Rating: {restaurant['rating']}/5",
+                f"Delivery time: {restaurant['delivery_time']}",
+                f"Delivery fee: ${restaurant['delivery_fee']}",
+                ""
+            ])
+            self._restaurant_text_cache[restaurant['name']] = info_text
+        return info_text
+    
+    def _format_function_result(self, function_name: str, result: Dict[str, Any]) -> str:
+        """Format function result for display"""
+        if not result.get("success", False):
+            return f"❌ {result.get('message', 'Unknown error')}"
         
-        return result.get('message', 'Function executed successfully')
+        formatter = self._formatters.get(function_name)
+        if formatter is None:
+            return result.get('message', 'Function executed successfully')
+        return formatter(result)
     
     def _extract_function_call(self, user_message: str, response_text: str) -> Optional[Dict[str, Any]]:
         """Extract function call from user message and Gemini response"""
-        import re
+        # Lowercase and split once; routing and argument extraction share the words
+        words = split_words(user_message)
+        tokens = tokenize(words)
+        routes = match_categories(tokens, self._keyword_index)
         
         # Check user message for order IDs first
-        order_match = re.search(r'FD\d{9}', user_message)
+        order_match = ORDER_RE.search(user_message)
         if order_match:
             order_id = order_match.group()
             
-            if (len(user_message.strip()) <= 15 or  
-                any(word in user_message.lower() for word in ["yes", "please", "ok", "okay", "sure", "track", "status", "where", "order", "delivery", "show", "details", "summary"])):
+            if len(user_message.strip()) <= 15 or "track_order" in routes:
                 return {
                     "function_name": "track_order",
                     "arguments": {"order_id": order_id}
                 }
             
-            if any(word in user_message.lower() for word in ["refund", "cancel", "return", "money back"]):
+            if "process_refund" in routes:
                 return {
                     "function_name": "process_refund",
                     "arguments": {"order_id": order_id, "reason": "Customer request"}
                 }
         
-        if any(word in user_message.lower() for word in ["how", "what", "when", "where", "can i", "do you", "payment", "cancel", "delivery", "time", "fee"]):
-            return {
-                "function_name": "search_faq",
-                "arguments": {"query": user_message}
-            }
-        
-        if any(restaurant in user_message.lower() for restaurant in ["mario", "sushi", "burger", "thai", "subway"]):
-            if "mario" in user_message.lower():
-                restaurant_name = "Mario's Pizza"
-            elif "sushi" in user_message.lower():
-                restaurant_name = "Sushi Palace"
-            elif "burger" in user_message.lower():
-                restaurant_name = "Burger King"
-            elif "thai" in user_message.lower():
-                restaurant_name = "Thai Garden"
-            elif "subway" in user_message.lower():
-                restaurant_name = "Subway"
+        for function_name in self._route_priority:
+            if function_name not in routes:
+                continue
+            
+            if function_name == "get_restaurant_info":
+                arguments = {"restaurant_name": match_restaurant(words)}
+            elif function_name == "escalate_to_human":
+                arguments = {"issue": user_message}
             else:
-                restaurant_name = "Mario's Pizza"  # default
+                arguments = {"query": user_message}
             
             return {
-                "function_name": "get_restaurant_info",
-                "arguments": {"restaurant_name": restaurant_name}
-            }
-        
-        if any(word in user_message.lower() for word in ["manager", "supervisor", "escalate", "complaint", "serious", "urgent"]):
-            return {
-                "function_name": "escalate_to_human",
-                "arguments": {"issue": user_message}
+                "function_name": function_name,
+                "arguments": arguments
             }
         
         return None
     
-    def chat(self, user_message: str, session_id: str = "default") -> Dict[str, Any]:
-        """Process user message and return AI response"""
-        try:
-            # Add user message to conversation history
-            self.conversation_history.append({"role": "user", "content": user_message})
-            
-            # Prepare context for Gemini
-            context = f"""You are a helpful customer support agent for a food delivery app. 
+    def _get_history(self, session_id: str) -> deque:
+        """Get the bounded conversation history for a session"""
+        with self._history_lock:
+            return self.conversation_history[session_id]
+    
+    def _build_context(self, user_message: str, history: deque) -> str:
+        """Build the Gemini prompt for an open-ended message"""
+        return f"""You are a helpful customer support agent for a food delivery app. 
 
 IMPORTANT: When a user provides an order ID (like FD123456789), you should suggest tracking that order. When they ask questions about policies, suggest searching FAQs.
 
@@ -188,13 +225,37 @@ Instructions:
 4. Always suggest the appropriate function when relevant
 
 Previous conversation:
-{self.conversation_history[-4:] if len(self.conversation_history) > 1 else []}
-            """
+{list(history)[-4:] if len(history) > 1 else []}
+        """
+    
+    def chat(self, user_message: str, session_id: str = "default", no_cache: bool = False, verbose: bool = False) -> Dict[str, Any]:
+        """Process user message and return AI response"""
+        try:
+            history = self._get_history(session_id)
+            
+            # Add user message to conversation history
+            history.append({"role": "user", "content": user_message})
             
-            response = self.model.generate_content(context)
-            response_text = response.text
+            # Order-specific answers are personal and time-dependent, never serve them from cache
+            use_cache = not no_cache and not verbose and not ORDER_RE.search(user_message)
+            if use_cache:
+                # Exact repeats are answered from a hash lookup; paraphrases fall through to the
+                # FAQ caches in SupportTools, so no embedding is computed here
+                cache_key = hashlib.blake2b(user_message.strip().lower().encode(), digest_size=16).digest()
+                cached = self.exact_cache.get(cache_key)
+                if cached:
+                    history.append({"role": "assistant", "content": cached["response"]})
+                    return {
+                        "success": True,
+                        "response": cached["response"],
+                        "session_id": session_id,
+                        "function_called": cached["function_called"],
+                        "ai_model": "gemini-2.0-flash-exp",
+                        "cached": True
+                    }
             
-            function_call = self._extract_function_call(user_message, response_text)
+            # Cheap keyword routing first; function calls render deterministically without Gemini
+            function_call = self._extract_function_call(user_message, "")
             
             if function_call:
                 function_result = self._call_function(
@@ -207,30 +268,42 @@ Previous conversation:
                     function_result
                 )
                 
-                final_context = f"""Based on the function call result, provide a helpful response to the customer.
-                
-                Function called: {function_call["function_name"]}
-                Function result: {json.dumps(function_result)}
-                Formatted result: {formatted_result}
-                
-                Original user message: {user_message}
-                
-                Provide a friendly, helpful response incorporating the function result."""
-                
-                final_response = self.model.generate_content(final_context)
-                full_response = f"{formatted_result}\n\n{final_response.text}"
+                if verbose:
+                    # Optional LLM rephrase of the function result (costs an extra Gemini call)
+                    final_context = f"""Based on the function call result, provide a helpful response to the customer.
+                    
+                    Function called: {function_call["function_name"]}
+                    Function result: {orjson.dumps(function_result).decode()}
+                    Formatted result: {formatted_result}
+                    
+                    Original user message: {user_message}
+                    
+                    Provide a friendly, helpful response incorporating the function result."""
+                    
+                    final_response = self.model.generate_content(final_context)
+                    full_response = f"{formatted_result}\n\n{final_response.text}"
+                else:
+                    full_response = f"{formatted_result}\n\nIs there anything else I can help you with?"
                 
             else:
-                full_response = response_text
+                # No deterministic route, so this needs an actual model reply
+                response = self.model.generate_content(self._build_context(user_message, history))
+                full_response = response.text
             
             # Add AI response to conversation history
-            self.conversation_history.append({"role": "assistant", "content": full_response})
+            history.append({"role": "assistant", "content": full_response})
+            
+            function_called = function_call["function_name"] if function_call else None
+            # Failed lookups (including tool exceptions) may be transient, so only successes are shared
+            if use_cache and function_called in _CACHEABLE_FUNCTIONS and function_result.get("success"):
+                cache_entry = {"response": full_response, "function_called": function_called}
+                self.exact_cache.put(cache_key, cache_entry)
             
             return {
                 "success": True,
                 "response": full_response,
                 "session_id": session_id,
-                "function_called": function_call["function_name"] if function_call else None,
+                "function_called": function_called,
                 "ai_model": "gemini-2.0-flash-exp"
             }
             
@@ -244,7 +317,8 @@ Previous conversation:
     
     def reset_conversation(self, session_id: str = "default"):
         """Reset conversation history for a session"""
-        self.conversation_history = []
+        with self._history_lock:
+            self.conversation_history.pop(session_id, None)
         return {"success": True, "message": "Conversation reset"}
 
 gemini_support_agent = GeminiSupportAgent()
@@ -4,8 +4,14 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse
 from pydantic import BaseModel
 from typing import Optional, Dict, Any
+import asyncio
 import os
 from dotenv import load_dotenv
+
+# One native thread per request: concurrency comes from the server, not from torch/BLAS pools.
+# Must be set before sentence_transformers (and torch) are imported below.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
 from app.gemini_agent import get_gemini_support_agent
 from app.demo_agent import get_demo_support_agent
 
@@ -27,6 +33,13 @@ app.add_middleware(
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# Read the chat interface once at startup instead of on every request to "/"
+try:
+    with open("static/index.html", "r", encoding="utf-8") as f:
+        INDEX_HTML = f.read()
+except FileNotFoundError:
+    INDEX_HTML = "<h1>Food Support AI Agent</h1><p>Static files not found. Please check deployment.</p>"
+
 try:
     support_agent = get_gemini_support_agent()
     demo_mode = False
@@ -56,11 +69,7 @@ class HealthResponse(BaseModel):
 @app.get("/", response_class=HTMLResponse)
 async def root():
     """Serve the main chat interface"""
-    try:
-        with open("static/index.html", "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read())
-    except FileNotFoundError:
-        return HTMLResponse(content="<h1>Food Support AI Agent</h1><p>Static files not found. Please check deployment.</p>")
+    return HTMLResponse(content=INDEX_HTML)
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat_endpoint(chat_message: ChatMessage):
@@ -69,7 +78,7 @@ async def chat_endpoint(chat_message: ChatMessage):
         if not chat_message.message.strip():
             raise HTTPException(status_code=400, detail="Message cannot be empty")
         
-        result = support_agent.chat(chat_message.message, chat_message.session_id)
+        result = await asyncio.to_thread(support_agent.chat, chat_message.message, chat_message.session_id)
         
         if demo_mode:
             result["demo_mode"] = True
@@ -96,7 +105,7 @@ async def chat_endpoint(chat_message: ChatMessage):
 async def reset_conversation(session_id: str = "default"):
     """Reset conversation history for a session"""
     try:
-        result = support_agent.reset_conversation(session_id)
+        result = await asyncio.to_thread(support_agent.reset_conversation, session_id)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error resetting conversation: {str(e)}")
@@ -114,7 +123,7 @@ async def health_check():
 async def get_order_info(order_id: str):
     """Get order information by ID (for testing)"""
     try:
-        result = support_agent.tools.track_order(order_id)
+        result = await asyncio.to_thread(support_agent.tools.track_order, order_id)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching order: {str(e)}")
@@ -123,7 +132,7 @@ async def get_order_info(order_id: str):
 async def search_faq(query: str):
     """Search FAQs (for testing)"""
     try:
-        result = support_agent.tools.search_faq(query)
+        result = await support_agent.tools.search_faq_async(query)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error searching FAQ: {str(e)}")
@@ -1,42 +1,124 @@
-import json
 import os
 import pickle
-from typing import List, Dict, Any, Tuple
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from functools import cached_property, lru_cache
+from typing import List, Dict, Any, Tuple, Callable
 import numpy as np
+import orjson
 import faiss
+import torch
 from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 
 load_dotenv()
 
+def filter_by_score(scores: np.ndarray, indices: np.ndarray, threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized threshold filter over search results; returns surviving (indices, scores)"""
+    mask = scores >= threshold
+    return indices[mask], scores[mask]
+
+class EmbeddingBatcher:
+    """Coalesce concurrent single-query encodes into one batched encode call"""
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], max_wait: float = 0.005, max_batch_size: int = 32):
+        self.encode_fn = encode_fn
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+    
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                embeddings = self.encode_fn([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+    
+    def encode(self, text: str) -> np.ndarray:
+        """Encode one text, sharing the model call with any concurrent requests"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
 class RAGEngine:
     def __init__(self, embedding_model: str = "all-MiniLM-L6-v2", index_path: str = "data/faiss_index.bin"):
         self.embedding_model = embedding_model
         self.index_path = index_path
-        self.model = SentenceTransformer(embedding_model)
+        
+        # Searches are tiny; parallelise across requests rather than inside each FAISS call
+        faiss.omp_set_num_threads(int(os.getenv("FAISS_THREADS", "1")))
         self.index = None
+        self.index_generation = 0  # Bumped whenever a new index is published, so callers can drop derived caches
         self.faqs = []
         self.dimension = 384  # Dimension for all-MiniLM-L6-v2
+        self.hnsw_m = 32  # Graph neighbours per node
+        self.hnsw_ef_construction = 200
+        self.hnsw_ef_search = 64
+        # IVF-PQ fast scan only pays off (and only trains well) once the corpus is large
+        self.ivf_min_vectors = 10000
+        self.ivf_nprobe = 16
         
+        self.query_batcher = EmbeddingBatcher(
+            lambda texts: self.model.encode(texts, batch_size=32, normalize_embeddings=True, convert_to_numpy=True)
+        )
+        # Cache query results on normalized text; cleared whenever the index changes
+        self._cached_search = lru_cache(maxsize=2048)(self._search_index)
+        self._cached_embedding = lru_cache(maxsize=2048)(self._embed)
+        # Serializes the lazy load/build so concurrent first searches don't see a half-built index
+        self._index_lock = threading.Lock()
+        
+    @cached_property
+    def model(self) -> SentenceTransformer:
+        """Embedding model, loaded on first use so processes that never embed skip the load"""
+        torch.set_num_threads(int(os.getenv("TORCH_THREADS", "1")))
+        return SentenceTransformer(self.embedding_model)
+    
     def load_faqs(self, faq_path: str = "data/faqs.json") -> List[Dict[str, Any]]:
         """Load FAQ data from JSON file"""
         try:
-            with open(faq_path, 'r', encoding='utf-8') as f:
-                self.faqs = json.load(f)
+            with open(faq_path, 'rb') as f:
+                self.faqs = orjson.loads(f.read())
             print(f"Loaded {len(self.faqs)} FAQs from {faq_path}")
             return self.faqs
         except FileNotFoundError:
             print(f"FAQ file not found: {faq_path}")
             return []
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"Error parsing FAQ JSON: {e}")
             return []
     
     def load_order_data(self, order_path: str = "data/order_database.json") -> List[Dict[str, Any]]:
         """Load order data and convert to FAQ format for RAG"""
         try:
-            with open(order_path, 'r', encoding='utf-8') as f:
-                orders = json.load(f)
+            with open(order_path, 'rb') as f:
+                orders = orjson.loads(f.read())
             
             # Convert orders to FAQ format for better RAG retrieval
             order_faqs = []
@@ -55,7 +137,7 @@ class RAGEngine:
         except FileNotFoundError:
             print(f"Order database not found: {order_path}")
             return []
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"Error parsing order JSON: {e}")
             return []
     
@@ -75,7 +157,10 @@ class RAGEngine:
             texts.append(combined_text)
         
         print(f"Creating embeddings for {len(texts)} entries (FAQs + Orders)...")
-        embeddings = self.model.encode(texts, show_progress_bar=True)
+        # Normalized at encode time so inner product equals cosine similarity
+        embeddings = self.model.encode(
+            texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=True
+        ).astype('float32', copy=False)
         print(f"Created embeddings with shape: {embeddings.shape}")
         return embeddings
     
@@ -83,44 +168,93 @@ class RAGEngine:
         """Build FAISS index from embeddings"""
         embeddings = self.create_embeddings()
         
-        # Create FAISS index
-        self.index = faiss.IndexFlatIP(self.dimension)  # Inner product for cosine similarity
+        if self._index_class_for(len(embeddings)) is faiss.IndexIVFPQFastScan:
+            # 4-bit PQ codes scanned with SIMD lookup tables; two dimensions per sub-quantizer keeps recall high
+            # FAISS wants ~39 training points per list, so small corpora get fewer lists
+            nlist = min(int(4 * np.sqrt(len(embeddings))), len(embeddings) // 39)
+            index = faiss.index_factory(self.dimension, f"IVF{nlist},PQ{self.dimension // 2}x4fs", faiss.METRIC_INNER_PRODUCT)
+        else:
+            # Create HNSW index over int8 scalar-quantized vectors (inner product for cosine similarity)
+            index = faiss.IndexHNSWSQ(self.dimension, faiss.ScalarQuantizer.QT_8bit, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = self.hnsw_ef_construction
         
-        # Normalize embeddings for cosine similarity
-        faiss.normalize_L2(embeddings)
+        # Train the quantizer, then add embeddings to index; only a complete index is published
+        index.train(embeddings)
+        index.add(embeddings)
+        self._set_search_params(index)
+        self.index = index
+        self.index_generation += 1
         
-        # Add embeddings to index
-        self.index.add(embeddings.astype('float32'))
+        self._cached_search.cache_clear()
         
         print(f"Built FAISS index with {self.index.ntotal} vectors")
         return self.index
     
+    def _index_class_for(self, num_vectors: int) -> type:
+        """FAISS index class build_index produces for a corpus of this size"""
+        return faiss.IndexIVFPQFastScan if num_vectors >= self.ivf_min_vectors else faiss.IndexHNSWSQ
+    
+    def _set_search_params(self, index: faiss.Index):
+        """Apply query-time search breadth for whichever index type is given"""
+        if hasattr(index, 'hnsw'):
+            index.hnsw.efSearch = self.hnsw_ef_search
+        elif hasattr(index, 'nprobe'):
+            index.nprobe = self.ivf_nprobe
+    
     def save_index(self):
         """Save FAISS index and FAQ data to disk"""
         if self.index is None:
             print("No index to save. Build index first.")
             return
         
-        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
-        
-        faiss.write_index(self.index, self.index_path)
+        index_dir = os.path.dirname(self.index_path)
+        os.makedirs(index_dir, exist_ok=True)
         
-        # Save FAQ data alongside index
+        # Each file is written beside its target and renamed into place, so other workers that
+        # have the old index memory-mapped keep a valid file and never read a partial one
         faq_data_path = self.index_path.replace('.bin', '_faqs.pkl')
-        with open(faq_data_path, 'wb') as f:
+        fd, tmp_faq_path = tempfile.mkstemp(dir=index_dir or ".", suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
             pickle.dump(self.faqs, f)
+        os.replace(tmp_faq_path, faq_data_path)
+        
+        fd, tmp_index_path = tempfile.mkstemp(dir=index_dir or ".", suffix=".tmp")
+        os.close(fd)
+        faiss.write_index(self.index, tmp_index_path)
+        os.replace(tmp_index_path, self.index_path)
         
         print(f"Saved index to {self.index_path} and FAQ data to {faq_data_path}")
     
     def load_index(self) -> bool:
         """Load FAISS index and FAQ data from disk"""
         try:
-            self.index = faiss.read_index(self.index_path)
+            # Memory-map the vectors so workers share the file's pages instead of each holding a copy
+            try:
+                index = faiss.read_index(self.index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError:
+                # Index types without mmap support are read fully into memory
+                index = faiss.read_index(self.index_path)
+            # Indexes saved by older code (e.g. the flat index shipped in data/) are rebuilt in the configured layout
+            expected = self._index_class_for(index.ntotal)
+            if not isinstance(index, expected):
+                print(f"Saved index is {type(index).__name__}, expected {expected.__name__}; rebuilding")
+                return False
+            self._set_search_params(index)
             
             # Load FAQ data
             faq_data_path = self.index_path.replace('.bin', '_faqs.pkl')
             with open(faq_data_path, 'rb') as f:
-                self.faqs = pickle.load(f)
+                faqs = pickle.load(f)
+            if len(faqs) != index.ntotal:
+                # Caught between another worker's two renames; rebuild rather than mix versions
+                print(f"Index has {index.ntotal} vectors but {len(faqs)} FAQs; rebuilding")
+                return False
+            
+            # Publish FAQs before the index, since searches start as soon as the index is set
+            self.faqs = faqs
+            self.index = index
+            self.index_generation += 1
+            self._cached_search.cache_clear()
             
             print(f"Loaded index with {self.index.ntotal} vectors and {len(self.faqs)} FAQs")
             return True
@@ -131,47 +265,72 @@ class RAGEngine:
             print(f"Error loading index: {e}")
             return False
     
-    def search(self, query: str, k: int = 3) -> List[Tuple[Dict[str, Any], float]]:
-        """Search for relevant FAQs using semantic similarity"""
-        if self.index is None:
-            if not self.load_index():
-                print("Building new index...")
-                self.build_index()
-                self.save_index()
-        
-        query_embedding = self.model.encode([query])
-        faiss.normalize_L2(query_embedding)
+    def _embed(self, query: str) -> np.ndarray:
+        """Embed a normalized query as a read-only (1, dimension) float32 array"""
+        query_embedding = self.query_batcher.encode(query).reshape(1, -1).astype('float32', copy=False)
+        query_embedding.flags.writeable = False
+        return query_embedding
+    
+    def embed_query(self, query: str) -> np.ndarray:
+        """Embed a query the same way search() does, reusing cached embeddings for repeats"""
+        return self._cached_embedding(query.strip().lower())
+    
+    def _search_index(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Embed a normalized query and return (scores, faq indices) arrays from the FAISS index"""
+        query_embedding = self._cached_embedding(query)
         
         # Search index
-        scores, indices = self.index.search(query_embedding.astype('float32'), k)
+        scores, indices = self.index.search(query_embedding, k)
         
-        # Return results with scores
-        results = []
-        for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-            if idx < len(self.faqs):
-                results.append((self.faqs[idx], float(score)))
+        valid = (indices[0] >= 0) & (indices[0] < len(self.faqs))  # HNSW pads missing neighbours with -1
+        scores, indices = scores[0][valid], indices[0][valid]
         
-        return results
+        # Results are shared through the cache, so keep them read-only
+        scores.flags.writeable = False
+        indices.flags.writeable = False
+        return scores, indices
+    
+    def search_arrays(self, query: str, k: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+        """Search for relevant FAQs and return raw (scores, faq indices) arrays"""
+        if self.index is None:
+            self._ensure_index()
+        
+        return self._cached_search(query.strip().lower(), k)
+    
+    def search(self, query: str, k: int = 3) -> List[Tuple[Dict[str, Any], float]]:
+        """Search for relevant FAQs using semantic similarity"""
+        scores, indices = self.search_arrays(query, k)
+        
+        # Return results with scores
+        return [(self.faqs[idx], score) for idx, score in zip(indices.tolist(), scores.tolist())]
     
     def get_relevant_faqs(self, query: str, threshold: float = 0.3) -> List[Dict[str, Any]]:
         """Get FAQs above similarity threshold"""
-        results = self.search(query, k=5)
+        scores, indices = self.search_arrays(query, k=5)
+        indices, scores = filter_by_score(scores, indices, threshold)
         relevant_faqs = []
         
-        for faq, score in results:
-            if score >= threshold:
-                faq_with_score = faq.copy()
-                faq_with_score['similarity_score'] = score
-                relevant_faqs.append(faq_with_score)
+        # Only FAQs that passed the threshold are looked up and copied
+        for idx, score in zip(indices.tolist(), scores.tolist()):
+            faq_with_score = self.faqs[idx].copy()
+            faq_with_score['similarity_score'] = score
+            relevant_faqs.append(faq_with_score)
         
         return relevant_faqs
     
+    def _ensure_index(self):
+        """Load the saved index, or build and save a new one, exactly once across threads"""
+        with self._index_lock:
+            if self.index is not None:
+                return
+            if not self.load_index():
+                print("Building new index...")
+                self.build_index()
+                self.save_index()
+    
     def initialize(self):
         """Initialize RAG engine - load existing index or build new one"""
-        if not self.load_index():
-            print("Building new RAG index...")
-            self.build_index()
-            self.save_index()
+        self._ensure_index()
         print("RAG engine initialized successfully!")
 
 rag_engine = RAGEngine()
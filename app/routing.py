@@ -0,0 +1,59 @@
+import re
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set
+
+ORDER_RE = re.compile(r'FD\d{9}')
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+_MIN_STEM_LENGTH = 3
+
+# Message keyword -> restaurant name as stored in data/restaurant_data.json
+RESTAURANT_MAP = {
+    "mario": "Mario's Pizza",
+    "sushi": "Sushi Palace",
+    "burger": "Burger King",
+    "thai": "Thai Garden",
+    "subway": "Subway"
+}
+
+def split_words(message: str) -> List[str]:
+    """Lowercase a message once and split it into word tokens"""
+    return _TOKEN_RE.findall(message.lower())
+
+def tokenize(words: List[str]) -> Set[str]:
+    """Expand a message's split_words() into word tokens plus adjacent-word bigrams ("can i", "money back")"""
+    tokens = set(words)
+    tokens.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    return tokens
+
+def match_restaurant(words: List[str]) -> Optional[str]:
+    """Return the restaurant whose keyword appears first in a message's split_words()"""
+    # Same words tokenize() routed on, so this agrees with keyword routing on what counts as a mention
+    for word in words:
+        restaurant = RESTAURANT_MAP.get(word)
+        if restaurant:
+            return restaurant
+    return None
+
+def build_keyword_index(categories: Dict[str, Iterable[str]]) -> Dict[str, FrozenSet[str]]:
+    """Invert {category: keywords} into {keyword: categories}; a keyword ending in "*" is a stem matching any word it starts"""
+    index: Dict[str, Set[str]] = defaultdict(set)
+    for category, keywords in categories.items():
+        for keyword in keywords:
+            index[keyword].add(category)
+    return {keyword: frozenset(matched) for keyword, matched in index.items()}
+
+def match_categories(tokens: Set[str], keyword_index: Dict[str, FrozenSet[str]]) -> Set[str]:
+    """Return every category with at least one keyword among the message tokens"""
+    matched = set()
+    for token in tokens:
+        token_categories = keyword_index.get(token)
+        if token_categories:
+            matched |= token_categories
+        if " " in token:
+            continue
+        # Stem keywords catch inflections ("track*" matches "tracking", "tracked")
+        for end in range(_MIN_STEM_LENGTH, len(token) + 1):
+            stem_categories = keyword_index.get(token[:end] + "*")
+            if stem_categories:
+                matched |= stem_categories
+    return matched
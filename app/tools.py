@@ -1,66 +1,216 @@
-import json
+import asyncio
+import inspect
 import os
-from typing import Dict, List, Any, Optional
+import pickle
+import tempfile
+import time
+import unicodedata
+from typing import Callable, Dict, List, Any, Optional, Tuple
 from datetime import datetime, timedelta
-import random
+import secrets
+import orjson
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 from app.rag_engine import get_rag_engine
+from app.cache import SemanticCache
+from app.routing import ORDER_RE, split_words
+
+# Refund reasons are matched on whole words, so e.g. "belated" does not count as "late"
+_FULL_REFUND_KWS = frozenset({"wrong", "damaged"})
+_PARTIAL_REFUND_KWS = frozenset({"late", "cold"})
+# Refund tier -> (refund type, share of the order total)
+_REFUND_TIERS = {"full": ("full", 1.0), "partial_20": ("partial", 0.2), "partial_50": ("partial", 0.5)}
+# RAG summary of an order; split at the status, the only field filled in per call
+_SUMMARY_FMT = (
+    "Order ID: {order_id}\n"
+    "Customer: {customer_name}\n"
+    "Restaurant: {restaurant}\n"
+    "Items: {_items_text}\n"
+    "Total: ${total_amount}\n"
+    "Status: {status}\n"
+    "Delivery Address: {delivery_address}\n"
+    "Order Time: {order_time}\n"
+    "Estimated Delivery: {estimated_delivery}"
+)
+_SUMMARY_HEAD_FMT, _SUMMARY_TAIL_FMT = _SUMMARY_FMT.split("{status}")
+# Orders still on their way to the customer
+_ACTIVE_STATUSES = frozenset({"confirmed", "preparing", "out_for_delivery"})
+# Orders not yet handed to a driver, eligible for a partial refund
+_REFUNDABLE_PENDING_STATUSES = frozenset({"confirmed", "preparing"})
+# Messages made only of these words carry no question worth a FAQ search
+_SMALL_TALK_WORDS = frozenset({"hi", "hello", "hey", "thanks", "thank", "you", "ok", "okay", "bye", "good", "morning", "afternoon", "evening"})
+
+# Bump whenever _load_order_database changes the fields it precomputes, to invalidate old caches
+_ORDER_CACHE_VERSION = 5
+
+def _parse_ts(value: Optional[str]) -> Optional[float]:
+    """Parse an ISO-8601 timestamp (with a trailing Z) into POSIX seconds"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+def _name_key(name: str) -> str:
+    """Normalize a name for case- and width-insensitive lookup"""
+    return unicodedata.normalize("NFKC", name).casefold()
+
+def requires_order(method: Optional[Callable] = None, *, not_found: str = "Order {order_id} not found."):
+    """Resolve a tool method's order_id to its order, passing it as the next argument or returning the not-found result"""
+    def decorate(method: Callable) -> Callable:
+        @wraps(method)
+        def wrapper(self, order_id: str, *args, **kwargs) -> Dict[str, Any]:
+            order = self._orders_by_id.get(order_id)
+            if order is None:
+                return {
+                    "success": False,
+                    "message": not_found.format(order_id=order_id),
+                    "order_id": order_id
+                }
+            return method(self, order_id, order, *args, **kwargs)
+        
+        # Advertise the public signature, without the injected order parameter
+        try:
+            signature = inspect.signature(method)
+        except ValueError:
+            # mypyc-compiled methods carry no introspectable signature
+            return wrapper
+        parameters = list(signature.parameters.values())
+        del parameters[2]
+        wrapper.__signature__ = signature.replace(parameters=parameters)  # type: ignore[attr-defined]
+        return wrapper
+    return decorate(method) if method is not None else decorate
+
+@lru_cache(maxsize=1)
+def _load_order_database() -> List[Dict[str, Any]]:
+    """Load order database from JSON file"""
+    order_path = "data/order_database.json"
+    try:
+        stat = os.stat(order_path)
+        # An unchanged file is restored from the pickled, already-preprocessed orders
+        cache_key = (_ORDER_CACHE_VERSION, order_path, stat.st_mtime_ns, stat.st_size)
+        cache_path = order_path + ".cache.pkl"
+        orders = _read_order_cache(cache_path, cache_key)
+        if orders is not None:
+            return orders
+
+        with open(order_path, 'rb') as f:
+            orders = orjson.loads(f.read())
+    except FileNotFoundError:
+        print("Order database not found")
+        return []
+
+    # Parse timestamps once here, as POSIX seconds so handlers compare plain floats against time.time()
+    for order in orders:
+        order["_est_ts"] = _parse_ts(order["estimated_delivery"])
+        order["_order_ts"] = _parse_ts(order["order_time"])
+        order["_items_text"] = ", ".join(f"{item['name']} (x{item['quantity']})" for item in order['items'])
+        # Summary text around the status line, which is the only field read live
+        order["_summary_head"], order["_summary_tail"] = _render_summary(order)
+        order["_refund_quotes"] = _build_refund_quotes(order["total_amount"])
+
+    _write_order_cache(cache_path, cache_key, orders)
+    return orders
+
+def _build_refund_quotes(total_amount: float) -> Dict[str, Tuple[str, float, str]]:
+    """Precompute (refund type, rounded amount, message) for every refund tier that pays out"""
+    quotes = {}
+    for tier, (refund_type, share) in _REFUND_TIERS.items():
+        refund_amount = total_amount * share
+        if refund_amount > 0:
+            message = f"Refund approved for ${refund_amount:.2f}. The amount will be credited to your original payment method within 3-5 business days."
+            quotes[tier] = (refund_type, round(refund_amount, 2), message)
+    return quotes
+
+def _read_order_cache(cache_path: str, cache_key: Tuple) -> Optional[List[Dict[str, Any]]]:
+    """Return cached preprocessed orders if the cache was written for this exact source file"""
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, orders = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ignoring unreadable order cache {cache_path}: {e}")
+        return None
+    return orders if cached_key == cache_key else None
+
+def _write_order_cache(cache_path: str, cache_key: Tuple, orders: List[Dict[str, Any]]):
+    """Persist preprocessed orders for the next process start"""
+    # Write to a temp file and rename it into place, so other workers never read a partial pickle
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path) or ".", suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((cache_key, orders), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Could not write order cache {cache_path}: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _render_summary(order: Dict[str, Any]) -> Tuple[str, str]:
+    """Render the static parts of an order's RAG summary, split where the status goes"""
+    head = _SUMMARY_HEAD_FMT.format_map(order)
+    tail = _SUMMARY_TAIL_FMT.format_map(order)
+    if order.get('driver_name'):
+        tail += f"\nDriver: {order['driver_name']}"
+    return head, tail
+
+@lru_cache(maxsize=1)
+def _load_restaurant_data() -> List[Dict[str, Any]]:
+    """Load restaurant data from JSON file"""
+    try:
+        with open("data/restaurant_data.json", 'rb') as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        print("Restaurant data not found")
+        return []
+
+@lru_cache(maxsize=1)
+def _load_refund_policies() -> Dict[str, Any]:
+    """Load refund policies from JSON file"""
+    try:
+        with open("data/refund_policies.json", 'rb') as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        print("Refund policies not found")
+        return {}
 
 class SupportTools:
     def __init__(self):
-        self.order_database = self._load_order_database()
-        self.restaurant_data = self._load_restaurant_data()
-        self.refund_policies = self._load_refund_policies()
+        # Loaders are cached per process, so every instance shares one parse of each file;
+        # the first load reads the three files concurrently so their disk waits overlap
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            orders = executor.submit(_load_order_database)
+            restaurants = executor.submit(_load_restaurant_data)
+            policies = executor.submit(_load_refund_policies)
+            self.order_database = orders.result()
+            self.restaurant_data = restaurants.result()
+            self.refund_policies = policies.result()
         self.rag_engine = get_rag_engine()
         
-    def _load_order_database(self) -> List[Dict[str, Any]]:
-        """Load order database from JSON file"""
-        try:
-            with open("data/order_database.json", 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print("Order database not found")
-            return []
-    
-    def _load_restaurant_data(self) -> List[Dict[str, Any]]:
-        """Load restaurant data from JSON file"""
-        try:
-            with open("data/restaurant_data.json", 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print("Restaurant data not found")
-            return []
-    
-    def _load_refund_policies(self) -> Dict[str, Any]:
-        """Load refund policies from JSON file"""
-        try:
-            with open("data/refund_policies.json", 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print("Refund policies not found")
-            return {}
-    
-    def track_order(self, order_id: str) -> Dict[str, Any]:
-        """Track an order by order ID with comprehensive summary"""
-        order = next((o for o in self.order_database if o["order_id"] == order_id), None)
-        
-        if not order:
-            return {
-                "success": False,
-                "message": f"Order {order_id} not found. Please check your order ID and try again.",
-                "order_id": order_id
-            }
+        # Key indexes so lookups are a single dict probe instead of a list scan
+        self._orders_by_id = {o["order_id"]: o for o in self.order_database}
+        self._restaurants_by_name = {_name_key(r["name"]): r for r in self.restaurant_data}
+        # Static part of each track_order response, so a call is one dict copy instead of a field-by-field build
+        self._track_responses = {o["order_id"]: self._build_track_response(o) for o in self.order_database}
+        # Column arrays for filter/aggregate scans over many orders; point lookups stay on the dict.
+        # These are a snapshot: nothing updates order status at runtime, so anything that starts
+        # doing so must rebuild them (unlike the per-order paths, which read status live)
+        self._order_status = np.array([o["status"] for o in self.order_database], dtype=str)
+        self._order_totals = np.array([o["total_amount"] for o in self.order_database], dtype=np.float64)
         
-        time_remaining = None
-        if order["status"] in ["confirmed", "preparing", "out_for_delivery"]:
-            estimated_delivery = datetime.fromisoformat(order["estimated_delivery"].replace('Z', '+00:00'))
-            now = datetime.now(estimated_delivery.tzinfo)
-            if estimated_delivery > now:
-                remaining_minutes = int((estimated_delivery - now).total_seconds() / 60)
-                time_remaining = f"{remaining_minutes} minutes"
+        # Set FAQ_QUERY_FILTER=false to send every query to the RAG engine
+        self.faq_query_filter = os.getenv("FAQ_QUERY_FILTER", "true").lower() == "true"
+        # Exact repeats are already cached inside the RAG engine; this catches near-identical paraphrases
+        self._faq_semantic_cache = SemanticCache(dimension=self.rag_engine.dimension, threshold=0.95)
+        self._faq_cache_generation = self.rag_engine.index_generation
         
-        order_summary = {
+    @staticmethod
+    def _build_track_response(order: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the fields of a track_order response that don't change between calls"""
+        return {
             "success": True,
-            "order_id": order_id,
+            "order_id": order["order_id"],
             "customer_name": order["customer_name"],
             "customer_phone": order["customer_phone"],
             "restaurant": order["restaurant"],
@@ -69,32 +219,33 @@ class SupportTools:
             "delivery_address": order["delivery_address"],
             "order_time": order["order_time"],
             "estimated_delivery": order["estimated_delivery"],
-            "status": order["status"],
-            "time_remaining": time_remaining,
+            "status": None,  # Filled in per call
+            "time_remaining": None,  # Filled in per call
             "driver_name": order.get("driver_name"),
             "driver_phone": order.get("driver_phone"),
             "special_instructions": order.get("special_instructions"),
             "delivery_time": order.get("delivery_time")
         }
+    
+    @requires_order(not_found="Order {order_id} not found. Please check your order ID and try again.")
+    def track_order(self, order_id: str, order: Dict[str, Any]) -> Dict[str, Any]:
+        """Track an order by order ID with comprehensive summary"""
+        time_remaining = None
+        if order["status"] in _ACTIVE_STATUSES:
+            seconds_left = order["_est_ts"] - time.time()
+            if seconds_left > 0:
+                remaining_minutes = int(seconds_left / 60)
+                time_remaining = f"{remaining_minutes} minutes"
         
-        return order_summary
+        # Copy the prebuilt response and fill in the per-call fields
+        return {**self._track_responses[order_id], "status": order["status"], "time_remaining": time_remaining}
     
-    def check_delivery_time(self, order_id: str) -> Dict[str, Any]:
+    @requires_order
+    def check_delivery_time(self, order_id: str, order: Dict[str, Any]) -> Dict[str, Any]:
         """Check delivery time for an order"""
-        order = next((o for o in self.order_database if o["order_id"] == order_id), None)
-        
-        if not order:
-            return {
-                "success": False,
-                "message": f"Order {order_id} not found.",
-                "order_id": order_id
-            }
-        
-        estimated_delivery = datetime.fromisoformat(order["estimated_delivery"].replace('Z', '+00:00'))
-        now = datetime.now(estimated_delivery.tzinfo)
+        seconds_left = order["_est_ts"] - time.time()
         
         if order["status"] == "delivered":
-            delivery_time = datetime.fromisoformat(order.get("delivery_time", order["estimated_delivery"]).replace('Z', '+00:00'))
             return {
                 "success": True,
                 "order_id": order_id,
@@ -102,8 +253,8 @@ class SupportTools:
                 "delivered_at": order.get("delivery_time"),
                 "message": "Your order has been delivered!"
             }
-        elif estimated_delivery > now:
-            remaining_minutes = int((estimated_delivery - now).total_seconds() / 60)
+        elif seconds_left > 0:
+            remaining_minutes = int(seconds_left / 60)
             return {
                 "success": True,
                 "order_id": order_id,
@@ -120,48 +271,36 @@ class SupportTools:
                 "message": "Your order is running late. Please contact support for assistance."
             }
     
-    def process_refund(self, order_id: str, reason: str) -> Dict[str, Any]:
+    @requires_order
+    def process_refund(self, order_id: str, order: Dict[str, Any], reason: str) -> Dict[str, Any]:
         """Process a refund request for an order"""
-        order = next((o for o in self.order_database if o["order_id"] == order_id), None)
-        
-        if not order:
-            return {
-                "success": False,
-                "message": f"Order {order_id} not found.",
-                "order_id": order_id
-            }
-        
         # Check if order is eligible for refund
-        order_time = datetime.fromisoformat(order["order_time"].replace('Z', '+00:00'))
-        now = datetime.now(order_time.tzinfo)
-        time_since_order = (now - order_time).total_seconds() / 3600  # hours
-        
-        refund_amount = 0
-        refund_type = "none"
+        time_since_order = (time.time() - order["_order_ts"]) / 3600  # hours
         
+        tier = None
         if time_since_order < 0.083:  # Less than 5 minutes
-            refund_amount = order["total_amount"]
-            refund_type = "full"
+            tier = "full"
         elif order["status"] == "delivered" and time_since_order < 2:  # Delivered within 2 hours
-            if "wrong" in reason.lower() or "damaged" in reason.lower():
-                refund_amount = order["total_amount"]
-                refund_type = "full"
-            elif "late" in reason.lower() or "cold" in reason.lower():
-                refund_amount = order["total_amount"] * 0.2  # 20% refund
-                refund_type = "partial"
-        elif order["status"] in ["confirmed", "preparing"]:
-            refund_amount = order["total_amount"] * 0.5  # 50% refund
-            refund_type = "partial"
+            reason_tokens = set(split_words(reason))
+            if reason_tokens & _FULL_REFUND_KWS:
+                tier = "full"
+            elif reason_tokens & _PARTIAL_REFUND_KWS:
+                tier = "partial_20"  # 20% refund
+        elif order["status"] in _REFUNDABLE_PENDING_STATUSES:
+            tier = "partial_50"  # 50% refund
         
-        if refund_amount > 0:
+        # Amounts and messages are prebuilt per order at load
+        quote = order["_refund_quotes"].get(tier)
+        if quote:
+            refund_type, refund_amount, message = quote
             return {
                 "success": True,
                 "order_id": order_id,
-                "refund_amount": round(refund_amount, 2),
+                "refund_amount": refund_amount,
                 "refund_type": refund_type,
                 "reason": reason,
                 "processing_time": "3-5 business days",
-                "message": f"Refund approved for ${refund_amount:.2f}. The amount will be credited to your original payment method within 3-5 business days."
+                "message": message
             }
         else:
             return {
@@ -171,9 +310,34 @@ class SupportTools:
                 "message": "This order is not eligible for a refund based on our policy. Please contact support for further assistance."
             }
     
+    def _search_relevant_faqs(self, query: str) -> List[Dict[str, Any]]:
+        """Retrieve FAQs for a query, reusing results for near-identical queries"""
+        # Results computed against a replaced index are stale
+        if self._faq_cache_generation != self.rag_engine.index_generation:
+            self._faq_semantic_cache.clear()
+            self._faq_cache_generation = self.rag_engine.index_generation
+        
+        query_embedding = self.rag_engine.embed_query(query)
+        relevant_faqs = self._faq_semantic_cache.get(query_embedding)
+        if relevant_faqs is None:
+            relevant_faqs = tuple(self.rag_engine.get_relevant_faqs(query, threshold=0.3))
+            self._faq_semantic_cache.put(query_embedding, relevant_faqs)
+        # Cached results are shared, so every caller gets its own copies
+        return [dict(faq) for faq in relevant_faqs]
+    
+    def _should_search(self, query: str) -> bool:
+        """Return False for queries that can't match a FAQ: empty, a bare order ID, or pure small talk"""
+        if ORDER_RE.fullmatch(query.strip().upper()):
+            return False
+        words = split_words(query)
+        return any(word not in _SMALL_TALK_WORDS for word in words)
+    
     def search_faq(self, query: str) -> Dict[str, Any]:
         """Search FAQs using RAG"""
-        relevant_faqs = self.rag_engine.get_relevant_faqs(query, threshold=0.3)
+        if self.faq_query_filter and not self._should_search(query):
+            relevant_faqs = []
+        else:
+            relevant_faqs = self._search_relevant_faqs(query)
         
         if not relevant_faqs:
             return {
@@ -189,10 +353,14 @@ class SupportTools:
             "message": f"Found {len(relevant_faqs)} relevant FAQ(s) for your query."
         }
     
+    async def search_faq_async(self, query: str) -> Dict[str, Any]:
+        """Search FAQs from async code, running the embedding and vector search in a worker thread"""
+        return await asyncio.to_thread(self.search_faq, query)
+    
     def escalate_to_human(self, issue: str) -> Dict[str, Any]:
         """Escalate complex issues to human support"""
-        # Generate a support ticket ID
-        ticket_id = f"TICKET-{random.randint(100000, 999999)}"
+        # Generate a support ticket ID (8 hex chars: ~4 billion values, no shared RNG lock)
+        ticket_id = f"TICKET-{secrets.token_hex(4).upper()}"
         
         return {
             "success": True,
@@ -209,7 +377,7 @@ class SupportTools:
     
     def get_restaurant_info(self, restaurant_name: str) -> Dict[str, Any]:
         """Get information about a restaurant"""
-        restaurant = next((r for r in self.restaurant_data if r["name"].lower() == restaurant_name.lower()), None)
+        restaurant = self._restaurants_by_name.get(_name_key(restaurant_name))
         
         if not restaurant:
             return {
@@ -223,40 +391,30 @@ class SupportTools:
             "message": f"Here's the information for {restaurant['name']}."
         }
     
-    def get_order_summary(self, order_id: str) -> Dict[str, Any]:
+    @staticmethod
+    def _public_order(order: Dict[str, Any]) -> Dict[str, Any]:
+        """Copy an order without the internal fields precomputed at load"""
+        return {key: value for key, value in order.items() if not key.startswith("_")}
+    
+    def orders_by_status(self, status: str) -> List[Dict[str, Any]]:
+        """Get all orders currently in the given status"""
+        return [self._public_order(self.order_database[i]) for i in np.flatnonzero(self._order_status == status).tolist()]
+    
+    def total_amount_by_status(self, status: str) -> float:
+        """Sum the order totals for all orders in the given status"""
+        return float(self._order_totals[self._order_status == status].sum())
+    
+    @requires_order
+    def get_order_summary(self, order_id: str, order: Dict[str, Any]) -> Dict[str, Any]:
         """Get comprehensive order summary for RAG retrieval"""
-        order = next((o for o in self.order_database if o["order_id"] == order_id), None)
-        
-        if not order:
-            return {
-                "success": False,
-                "message": f"Order {order_id} not found.",
-                "order_id": order_id
-            }
-        
-        # Create a comprehensive summary for RAG
-        items_text = ", ".join([f"{item['name']} (x{item['quantity']})" for item in order['items']])
-        
-        summary = f"""
-        Order ID: {order['order_id']}
-        Customer: {order['customer_name']}
-        Restaurant: {order['restaurant']}
-        Items: {items_text}
-        Total: ${order['total_amount']}
-        Status: {order['status']}
-        Delivery Address: {order['delivery_address']}
-        Order Time: {order['order_time']}
-        Estimated Delivery: {order['estimated_delivery']}
-        """
-        
-        if order.get('driver_name'):
-            summary += f"Driver: {order['driver_name']}"
+        # Static text is rendered at load; only the status is filled in per call
+        summary = f"{order['_summary_head']}{order['status']}{order['_summary_tail']}"
         
         return {
             "success": True,
             "order_id": order_id,
-            "summary": summary.strip(),
-            "order_data": order
+            "summary": summary,
+            "order_data": self._public_order(order)
         }
 
 support_tools = SupportTools()